@@ -1,15 +1,68 @@
 import pandas as pd
 from tqdm import tqdm
 import numpy as np
-import re
 import glob
-import json
-import utils.flatten as flt
+import mmap
+import os
+import orjson
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+SELECTED_COLUMNS = [
+    "raceId",
+    "date",
+    "horse.genyId",
+    "musique",
+    "results.position",
+    "priceFirst",
+]
+# Columns read by the preprocessing and the augmented music retrieval
+REQUIRED_COLUMNS = [
+    "date",
+    "horse.genyId",
+    "musique",
+    "results.position",
+    "priceFirst",
+]
+# Indication of a new year in a music, e.g. "(17)"
+PARENTHESES_PATTERN = r"\([^)]*\)"
+NON_DIGIT_PATTERN = r"[^1-9]"
+
+
+def read_race_file(file_path):
+    """Extract the performances of every horse of a race JSON file
+
+    Arguments:
+        file_path {string} -- Path of a historic JSON file
+
+    Returns:
+        dict -- Performances of the horses that took part in the race, one list per selected column
+    """
+    with open(file_path, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mapped_file, memoryview(mapped_file) as buffer:
+        data = orjson.loads(buffer)
+    date = data["raceScheduledStartEpochMs"]
+    price_first = (data.get("price") or {}).get("first")
+    # Des fichiers n'ont pas le genyId comme raceId, mais un nom courant
+    race_id = data.get("genyId")
+
+    horses = data["partants"]
+    return {
+        "raceId": [race_id] * len(horses),
+        "date": [date] * len(horses),
+        "horse.genyId": [(horse.get("horse") or {}).get("genyId") for horse in horses],
+        "musique": [horse.get("musique") for horse in horses],
+        "results.position": [
+            (horse.get("results") or {}).get("position") for horse in horses
+        ],
+        "priceFirst": [price_first] * len(horses),
+    }
 
 
 def glob_to_df(files_paths_glob):
-    """Aggregate JSON files containing horse race data described by the glob pattern into a DataFrame, with desired columns
+    """Aggregate JSON files containing horse race data described by the glob pattern into a DataFrame, with desired columns.
+    Files are read in parallel, one worker process per CPU.
 
     Arguments:
         files_paths_glob {string} -- Glob file pattern of historic JSON files. Should be complete (end with .json)
@@ -19,37 +72,13 @@ def glob_to_df(files_paths_glob):
     """
     files_paths = glob.glob(files_paths_glob)
     print(f"Data extraction from {len(files_paths)} JSON files...")
-    pbar = tqdm(total=len(files_paths))
-    performances = []
-    for file_path in files_paths:
-        with open(file_path, "r", encoding="utf-8") as file:
-            data = json.load(file)
-            pbar.update()
-            for horse in data["partants"]:
-                horse_performance = flt.flatten_dic(horse)
-                horse_performance["date"] = data["raceScheduledStartEpochMs"]
-                try:
-                    horse_performance["priceFirst"] = data["price"]["first"]
-                except:
-                    pass
-
-                # Des fichiers n'ont pas le genyId comme raceId, mais un nom courant
-                try:
-                    horse_performance["raceId"] = data["genyId"]
-                except:
-                    pass
-
-                performances += [horse_performance]
-    pbar.refresh()
-    selected_columns = [
-        "raceId",
-        "date",
-        "horse.genyId",
-        "musique",
-        "results.position",
-        "priceFirst",
-    ]
-    return pd.DataFrame(performances)[selected_columns]
+    columns = {column: [] for column in SELECTED_COLUMNS}
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        races = executor.map(read_race_file, files_paths, chunksize=16)
+        for race_columns in tqdm(races, total=len(files_paths)):
+            for column, values in race_columns.items():
+                columns[column].extend(values)
+    return pd.DataFrame(columns).astype({"musique": "string[pyarrow]"})
 
 
 def preprocess_df(df):
@@ -64,83 +93,123 @@ def preprocess_df(df):
 
     Returns:
         df -- Preprocessed DataFrame
+
+    Raises:
+        KeyError -- If one of the required columns is missing
     """
+    missing_columns = [column for column in REQUIRED_COLUMNS if column not in df]
+    if missing_columns:
+        raise KeyError(f"Missing columns in the performances: {missing_columns}")
     print(
         f"Preprocessing the horse performances dataframe containing {len(df)} rows..."
     )
     df["date"] = pd.to_datetime(df["date"], unit="ms")
-    df["results.position"] = df["results.position"].apply(clean_results_position)
-    df["cleaned_music"] = df["musique"].apply(clean_music_to_list)
+    df["results.position"] = clean_results_position(df["results.position"])
+    df["cleaned_music"] = clean_music_to_list(df["musique"])
     return df
 
 
 def clean_results_position(result_position):
     """Ceil the result position to 10 and attribute 10 to a non ranked performance
+    (missing, non numeric such as 'D', or not positive such as 0)
 
     Arguments:
-        result_position {string} -- The arriving rank of the horse (can be 'D' for disqualified)
+        result_position {Series} -- The arriving ranks of the horses (can be 'D' for disqualified)
 
     Returns:
-        int -- corrected result position
+        Series -- corrected result positions
     """
-    if pd.isnull(result_position):
-        return 10
-    else:
-        return max(int(result_position), 10)
+    positions = pd.to_numeric(result_position, errors="coerce").fillna(10)
+    return positions.where(positions >= 1, 10).clip(upper=10).astype(np.int8)
 
 
 def clean_music_to_list(music):
     """Supress letters (for race type) and new year indication (number between parentheses)
 
     Arguments:
-        music {string} -- Music as given by websites
-        (a word alterning numbers and letters)
+        music {Series} -- Musics as given by websites
+        (words alterning numbers and letters)
 
     Returns:
-        int list -- cleaned music
+        Series -- cleaned musics, as lists of positions (empty for a missing music)
     """
-    if pd.isnull(music):
-        return []
-
-    musique = re.sub(r"\([^)]*\)", "", music)
-    musique = re.sub("[^1-9]", " ", music)
-    musique = musique.split()
-    return musique
+    return (
+        music.fillna("")
+        .str.replace(PARENTHESES_PATTERN, "", regex=True)
+        .str.replace(NON_DIGIT_PATTERN, " ", regex=True)
+        .str.split()
+    )
 
 
-def get_music(horse):
-    """Creates augmented music from one horse's performances
+def get_music(first_music, positions, prices, dates, augmented_music):
+    """Creates augmented music from one horse's performances, in place
 
     Arguments:
-        horse {DataFrame} -- Horses performances, in chronological order
+        first_music {string list} -- Cleaned music of the horse at its first performance
+        positions {np.array} -- Result positions of the horse, in chronological order
+        prices {np.array} -- Cash prizes of the races of the horse, in chronological order
+        dates {np.array} -- Dates (epoch in ms) of the races of the horse, in chronological order
+        augmented_music {2D np.array} -- Output buffer, with one row per result of the first music and per performance
 
     Returns:
-        2D np.array -- augmented music with date, cash prize, and position.
+        2D np.array -- augmented music with position, cash prize, and date.
         Each element of the list is a performance, which is a list of the 3 features
     """
-    first_music = horse["cleaned_music"].iloc[0]
-    augmented_music = horse[["results.position", "priceFirst", "date"]].values
-    if first_music:
-        augmented_music = np.vstack(
-            [
-                [[float(result), np.NaN, np.NaN] for result in first_music],
-                augmented_music,
-            ]
-        )
+    n_first = len(first_music)
+    if n_first:
+        augmented_music[:n_first, 0] = [float(result) for result in first_music]
+        augmented_music[:n_first, 1:] = np.NaN
+    augmented_music[n_first:, 0] = positions
+    augmented_music[n_first:, 1] = prices
+    augmented_music[n_first:, 2] = dates
     return augmented_music
 
 
 def get_augmented_music_df(df):
-    """Retrieve the augmented music for each horse appearing in the horses' performances dataframe
+    """Retrieve the augmented music for each horse appearing in the horses' performances dataframe.
+    Performances are sorted by horse and date, so that each horse is a contiguous slice of rows.
+    All augmented musics are views on a single buffer, one block of rows per horse.
 
     Arguments:
         df {DataFrame} -- Horses performances
 
     Returns:
-        DataFrame -- Output of the program : DataFrame with
+        Series -- Output of the program : augmented music of each horse, indexed by horse id
     """
     print("Retrieving augmented music for each horse...")
-    return df.groupby(["horse.genyId"]).apply(get_music)
+    df = df.dropna(subset=["horse.genyId"]).sort_values(
+        ["horse.genyId", "date"], kind="stable"
+    )
+    ids = df["horse.genyId"].to_numpy()
+    if not len(ids):
+        return pd.Series(dtype=object, index=pd.Index([], name="horse.genyId"))
+    musics = df["cleaned_music"].to_numpy()
+    positions = df["results.position"].to_numpy()
+    prices = df["priceFirst"].to_numpy(dtype=np.float64)
+    dates = df["date"].to_numpy().astype("datetime64[ms]")
+    dates = np.where(np.isnat(dates), np.NaN, dates.view("i8"))
+
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    ends = np.r_[starts[1:], len(ids)]
+    first_musics = musics[starts]
+    n_first = np.fromiter(map(len, first_musics), np.int64, len(starts))
+    offsets = np.r_[0, np.cumsum(n_first + ends - starts)]
+    buffer = np.empty((offsets[-1], 3), dtype=np.float64)
+    return pd.Series(
+        [
+            get_music(
+                first_music,
+                positions[start:end],
+                prices[start:end],
+                dates[start:end],
+                buffer[offset_start:offset_end],
+            )
+            for first_music, start, end, offset_start, offset_end in zip(
+                first_musics, starts, ends, offsets[:-1], offsets[1:]
+            )
+        ],
+        index=pd.Index(ids[starts], name="horse.genyId"),
+    )
 
 
 def parse_args():
@@ -168,7 +237,9 @@ def parse_args():
 
 def main():
     args = parse_args()
-    get_augmented_music_df(preprocess_df(glob_to_df(args.input))).to_csv(args.output)
+    augmented_musics = get_augmented_music_df(preprocess_df(glob_to_df(args.input)))
+    # Lists keep full precision, numpy would print arrays rounded to 8 digits
+    augmented_musics.map(np.ndarray.tolist).to_csv(args.output)
 
 
 if __name__ == "__main__":